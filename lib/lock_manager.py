@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import time
+import random
 import weakref
 import logging
 import threading
-from collections import deque
+
+try:
+    # Reentrant lock implemented in C. On Python 2, threading.RLock is
+    # implemented in Python and a lot slower.
+    from fastrlock.rlock import FastRLock as _RLock
+except ImportError:
+    _RLock = threading.RLock
 
 _logger = logging.getLogger(__name__)
 
@@ -23,15 +31,30 @@ LEVEL_NAMES = {
 
 assert LOCK_NONE < LOCK_SHARED < LOCK_RESERVED < LOCK_PENDING < LOCK_EXCLUSIVE
 
+#: SQLite result code for a lock held by another connection or process.
+SQLITE_BUSY = 5
+
+#: SQLite extended result code for a failure of the OS level locking.
+SQLITE_IOERR_LOCK = 10 | (15 << 8)
+
 
-def _ascend_level(old_level, new_level):
-    r = []
-    for level in (1, 2, 4):
-        if level > new_level:
-            break
-        if level > old_level:
-            r.append(level)
-    return r
+#: Levels to pass to the VFS lock function to go from one lock level to a
+#: higher one, indexed by [old_level][new_level]. LOCK_PENDING is never
+#: requested directly, it is managed internally by the OS layer.
+_ASCEND_LEVELS = tuple(
+        tuple(tuple(level for level in (LOCK_SHARED, LOCK_RESERVED, LOCK_EXCLUSIVE) if old_level < level <= new_level)
+              for new_level in sorted(LEVEL_NAMES))
+        for old_level in sorted(LEVEL_NAMES))
+
+
+def _format_state(name, level_counts, blocked_count):
+    """
+    Formats the state of a lock for __repr__, given the number of clients
+    holding each lock level as (level, count) pairs sorted by level.
+    """
+    holder_summary = ", ".join("{0}: {1}".format(LEVEL_NAMES.get(level) or level, count)
+            for (level, count) in level_counts if count)
+    return '<{0} {1}, {2} blocked>'.format(name, holder_summary or "IDLE", blocked_count)
 
 
 class DeadlockError(Exception):
@@ -140,98 +163,173 @@ class DefaultLockManager(LockManager):
     :param float timeout: Timeout for lock operations in seconds (default: 5)
     :param SharedExclusiveLock: SharedExclusiveLock class to use for per-file lock,
             by default the SharedExclusiveLock class in this module is used.
+    :param bool backoff: If true, a client whose OS level lock attempt failed
+            with SQLITE_BUSY (another process holds the lock) sleeps before the
+            failure is reported. The delay doubles with each consecutive
+            failure, from BACKOFF_MIN up to BACKOFF_MAX seconds.
     """
 
-    def __init__(self, timeout=5, SharedExclusiveLock=None):
+    #: Initial and maximum delay in seconds for backoff after lock failures
+    BACKOFF_MIN = 0.01
+    BACKOFF_MAX = 0.5
+
+    def __init__(self, timeout=5, SharedExclusiveLock=None, backoff=False):
         if SharedExclusiveLock is None:
             SharedExclusiveLock = globals()["SharedExclusiveLock"]
 
         #: SharedExclusiveLock implementation to use
         self.SharedExclusiveLock = SharedExclusiveLock
 
-        #: Protects the lock manager and its contained SharedExclusiveLocks
-        self._mutex = threading.RLock()
+        #: Protects _filelocks and _filelock_users. Each SharedExclusiveLock
+        #: has its own mutex, so locking different files does not serialize.
+        #: This must be reentrant: any allocation may run the garbage collector,
+        #: which may close a connection and thereby call unlock.
+        self._mutex = _RLock()
 
         #: Individual lock for each filename, as mapping name -> lock
         self._filelocks = {}
 
+        #: Number of lock/unlock calls currently using the lock of each
+        #: filename, as mapping name -> count. A lock is only dropped from
+        #: _filelocks if it is idle and not in use.
+        self._filelock_users = {}
+
         #: How long to wait to get a lock in seconds (None: block forever)
         self.timeout = timeout
 
+        #: Whether to back off after failures of the OS level locking
+        self.backoff = backoff
+
+        #: Next backoff delay for each (filename, client) whose last OS level
+        #: lock attempt failed
+        self._backoff_delays = {}
+
     def lock(self, lockfunc, filename, level, client):
-        # print repr(("lock", lockfunc, filename, level, client))
-        with self._mutex:
-            filelock = self._filelocks.get(filename)
-            if not filelock:
-                filelock = self.SharedExclusiveLock(mutex=self._mutex,
-                        timeout=self.timeout, resource=filename)
-                self._filelocks[filename] = filelock
-            try:
-                old_level = filelock.lock(level, client)
-            except _LockTimeoutError:
-                raise DeadlockError()
-            finally:
-                if filelock.is_idle():
-                    self._filelocks.pop(filename, None)
+        filelock = self._get_filelock(filename)
+        try:
+            old_level = filelock.lock(level, client)
+        except _LockTimeoutError:
+            raise DeadlockError()
+        finally:
+            self._release_filelock(filename, filelock)
 
         try:
-            levels = _ascend_level(old_level, level)
-            for l in levels:
+            for l in _ASCEND_LEVELS[old_level][level]:
                 lockfunc(l)
             self.lock_result(filename, level, client, 0)
-        except Exception, e:
-            # print "lockfunc raised {0}: {1}.".format(type(e).__name__, repr(e.args))
-            self.unlock(filename, old_level, client)
-            resultcode = e.args[0]
+        except Exception as e:
+            # Not self.unlock, which would reset the backoff delay
+            self._unlock(filename, old_level, client)
+            # Like the C module, use the SQLite error code of a CallbackError
+            # and report anything else as generic lock error.
+            if len(e.args) == 1 and isinstance(e.args[0], int):
+                resultcode = e.args[0]
+            else:
+                resultcode = SQLITE_IOERR_LOCK
             self.lock_result(filename, level, client, resultcode)
+            if self.backoff and resultcode == SQLITE_BUSY:
+                self._backoff(filename, client)
             raise
 
+        if self.backoff:
+            self._backoff_delays.pop((filename, client), None)
+
+    def _backoff(self, filename, client):
+        """
+        Sleeps after a failed OS level lock attempt of *client* on *filename*.
+        Uses exponential backoff with some random jitter so that clients
+        competing for the same file do not retry in lockstep.
+        """
+        key = (filename, client)
+        delay = self._backoff_delays.get(key, self.BACKOFF_MIN)
+        self._backoff_delays[key] = min(delay * 2, self.BACKOFF_MAX)
+        time.sleep(delay + random.uniform(0, delay * 0.1))
+
     def lock_result(self, filename, level, client, resultcode):
-        # print repr(("lock_result", filename, level, client, resultcode))
         pass
 
     def unlock(self, filename, level, client):
-        # print repr(("unlock", filename, level, client))
+        if level == LOCK_NONE and self._backoff_delays:
+            # The client is done with the file (usually the connection is
+            # closed), so forget its backoff delay.
+            self._backoff_delays.pop((filename, client), None)
+        return self._unlock(filename, level, client)
+
+    def _unlock(self, filename, level, client):
+        filelock = self._get_filelock(filename, create=False)
+        if filelock is None:
+            # Nobody holds a lock on the file (SQLite sometimes unlocks
+            # without locking first), so there is nothing to do.
+            return
+        try:
+            return filelock.unlock(level, client)
+        finally:
+            self._release_filelock(filename, filelock)
+
+    def _get_filelock(self, filename, create=True):
+        """
+        Returns the SharedExclusiveLock for *filename*. If there is none, it
+        is created, or None is returned if *create* is false. The lock is kept
+        in _filelocks until the matching call of _release_filelock, so that
+        concurrent callers (especially those blocked in SharedExclusiveLock.lock)
+        always work on the same instance.
+        """
         with self._mutex:
             filelock = self._filelocks.get(filename)
-            if not filelock:
-                filelock = self.SharedExclusiveLock(mutex=self._mutex,
-                        timeout=self.timeout, resource=filename)
+            if filelock is None:
+                if not create:
+                    return None
+                filelock = self.SharedExclusiveLock(timeout=self.timeout, resource=filename)
                 self._filelocks[filename] = filelock
-            try:
-                return filelock.unlock(level, client)
-            finally:
-                if filelock.is_idle():
-                    self._filelocks.pop(filename, None)
+                self._filelock_users[filename] = 1
+            else:
+                self._filelock_users[filename] += 1
+            return filelock
+
+    def _release_filelock(self, filename, filelock):
+        """Releases a lock returned by _get_filelock, dropping it if it is no longer needed."""
+        with self._mutex:
+            users = self._filelock_users[filename] - 1
+            if users or not filelock.is_idle():
+                self._filelock_users[filename] = users
+            else:
+                del self._filelocks[filename]
+                del self._filelock_users[filename]
 
     def is_idle(self):
         with self._mutex:
             return not self._filelocks
 
     def __repr__(self):
+        if not self._filelocks:
+            # Idle: no need to take the mutex and collect statistics
+            return _format_state(type(self).__name__, (), 0)
+
+        # get_stats takes the mutex of each file lock, so call it without
+        # holding our mutex. A finalizer run while a file lock mutex is held
+        # may call unlock, which takes the mutexes in the opposite order.
         with self._mutex:
-            level_counts = {}
-            blocked_count = 0
+            filelocks = list(self._filelocks.values())
 
-            for filename, filelock in self._filelocks.iteritems():
-                file_level_counts, file_blocked_count = filelock.get_stats()
-                for level, count in file_level_counts.items():
-                    level_counts[level] = level_counts.get(level, 0) + count
-                blocked_count += file_blocked_count
-
-        if level_counts:
-            holder_parts = []
-            for level, count in sorted(level_counts.items()):
-                holder_parts.append("{0}: {1}".format(LEVEL_NAMES.get(level) or level, count))
-            holder_summary = ", ".join(holder_parts)
-        else:
-            holder_summary = "IDLE"
+        level_counts = {}
+        blocked_count = 0
+
+        # Only use the public get_stats: a custom SharedExclusiveLock
+        # class may not have _get_counts or use additional lock levels.
+        for filelock in filelocks:
+            file_level_counts, file_blocked_count = filelock.get_stats()
+            for level, count in file_level_counts.items():
+                level_counts[level] = level_counts.get(level, 0) + count
+            blocked_count += file_blocked_count
 
-        return '<{0} {1}, {2} blocked>'.format(type(self).__name__, holder_summary, blocked_count)
+        return _format_state(type(self).__name__, sorted(level_counts.items()), blocked_count)
 
 
 class SharedExclusiveLock(object):
 
+    __slots__ = ("resource", "_mutex", "_lock_holders", "_lock_holder_caller_info", "_level_counts",
+            "_max_level", "_queue_head", "_queue_tail", "_free_blocked_infos", "timeout")
+
     def __init__(self, mutex=None, timeout=None, resource=None):
         if resource is None:
             resource = "<unknown>"
@@ -239,27 +337,42 @@ class SharedExclusiveLock(object):
         #: Name of the resource that we are protecting
         self.resource = resource
 
-        #: Mutex used to implement the monitor pattern of the lock.
-        self._mutex = threading.RLock() if mutex is None else mutex
+        #: Mutex used to implement the monitor pattern of the lock. It must be
+        #: reentrant: any allocation (or the _get_caller_info hook) may run the
+        #: garbage collector, which may close a connection to the same file
+        #: and thereby call unlock.
+        self._mutex = _RLock() if mutex is None else mutex
 
         #: Map of clients to the lock level they are holding. Contains only
         #: clients actually holding a lock.
         self._lock_holders = {}
 
         #: Caller info for each client in _lock_holders. Can be any object as
-        #: returned by the method _get_caller_info.
+        #: returned by the method _get_caller_info. Clients without caller info
+        #: (the default) are not stored.
         self._lock_holder_caller_info = {}
 
-        #: Queue of clients blocked waiting for the lock. Each entry is an
-        #: instance of BlockedClientInfo.
-        self._blocked_clients = deque()
+        #: Number of clients holding each lock level, indexed by level.
+        self._level_counts = [0] * len(LEVEL_NAMES)
+
+        #: Highest lock level held by any client.
+        self._max_level = LOCK_NONE
+
+        #: First and last entry of the queue of clients blocked waiting for
+        #: the lock. The entries are BlockedClientInfo instances linked via
+        #: their _prev and _next attributes, so that a client that timed out
+        #: can be removed in constant time.
+        self._queue_head = None
+        self._queue_tail = None
+
+        #: BlockedClientInfo instances of clients that got the lock, kept for
+        #: reuse by _enqueue to avoid allocating a new Event for each wait.
+        self._free_blocked_infos = []
 
         #: Timeout for blocked clients. After waiting this many seconds, a
         #: busy error is returned.
         self.timeout = timeout
 
-        self.check_invariant()
-
     def lock(self, level, client):
         """
         Acquires a lock at the *level* for *client*. If the client already
@@ -282,33 +395,86 @@ class SharedExclusiveLock(object):
         """
         with self._mutex:
             old_level = self._lock_holders.get(client, LOCK_NONE)
+            if level <= old_level:
+                return old_level
+
             caller_info = self._get_caller_info()
-            if level > old_level:
-
-                if level == LOCK_SHARED:
-                    self._acquire_shared(client, old_level, caller_info)
-                elif level == LOCK_RESERVED:
-                    self._acquire_reserved(client, old_level, caller_info)
-                elif level == LOCK_EXCLUSIVE:
-                    self._acquire_exclusive(client, old_level, caller_info)
-                else:
-                    raise ValueError(
-                            "Bad lock level {0}, must be LOCK_SHARED ({1}), LOCK_RESERVED ({2}) or LOCK_EXCLUSIVE ({3}))."
-                            .format(level, LOCK_SHARED, LOCK_RESERVED, LOCK_EXCLUSIVE))
-
-            self.check_invariant()
-            return old_level
+            if level == LOCK_SHARED:
+                # The client holds no lock yet, so only a pending or exclusive
+                # lock of another client or a queued client can get in the way.
+                if self._max_level < LOCK_PENDING and self._queue_head is None:
+                    self._set_level(client, LOCK_SHARED, caller_info)
+                    return old_level
+                blocked_info = self._enqueue(client, LOCK_SHARED, caller_info)
+            elif level == LOCK_RESERVED:
+                blocked_info = self._acquire_reserved(client, old_level, caller_info)
+            elif level == LOCK_EXCLUSIVE:
+                blocked_info = self._acquire_exclusive(client, old_level, caller_info)
+            else:
+                raise ValueError(
+                        "Bad lock level {0}, must be LOCK_SHARED ({1}), LOCK_RESERVED ({2}) or LOCK_EXCLUSIVE ({3}))."
+                        .format(level, LOCK_SHARED, LOCK_RESERVED, LOCK_EXCLUSIVE))
+
+        if blocked_info is not None:
+            self._wait(blocked_info)
+        return old_level
 
     def unlock(self, level, client):
         with self._mutex:
             old_level = self._lock_holders.get(client, LOCK_NONE)
-            if level < old_level:
-                if level == LOCK_NONE:
-                    del self._lock_holders[client]
-                    self._lock_holder_caller_info.pop(client)
-                else:
-                    self._lock_holders[client] = level
-                self._wakeup_blocked()
+            if level >= old_level:
+                return
+            self._set_level(client, level)
+            if self._queue_head is None:
+                return
+            granted = self._wakeup_blocked()
+
+        for blocked_info in granted:
+            blocked_info.signal()
+
+    def _set_level(self, client, level, caller_info=None):
+        """
+        Sets the lock level held by *client* and updates the derived state
+        (_level_counts and _max_level). Setting LOCK_NONE removes
+        the client from the lock holders. The caller must hold the mutex.
+        """
+        level_counts = self._level_counts
+        if level != LOCK_NONE:
+            old_level = self._lock_holders.get(client, LOCK_NONE)
+            self._lock_holders[client] = level
+            level_counts[level] += 1
+            if caller_info is not None:
+                self._lock_holder_caller_info[client] = caller_info
+            elif level > old_level and self._lock_holder_caller_info:
+                # Do not report the caller info of the lower level for the new one
+                self._lock_holder_caller_info.pop(client, None)
+        else:
+            old_level = self._lock_holders.pop(client)
+            if self._lock_holder_caller_info:
+                self._lock_holder_caller_info.pop(client, None)
+        if old_level != LOCK_NONE:
+            level_counts[old_level] -= 1
+
+        if level > self._max_level:
+            self._max_level = level
+        elif old_level == self._max_level and not level_counts[old_level]:
+            max_level = old_level - 1
+            while max_level > LOCK_NONE and not level_counts[max_level]:
+                max_level -= 1
+            self._max_level = max_level
+
+    def _other_max_level(self, client):
+        """Returns the highest lock level held by any client but *client*."""
+        level = self._lock_holders.get(client, LOCK_NONE)
+        max_level = self._max_level
+        if level == LOCK_NONE or level != max_level or self._level_counts[level] > 1:
+            return max_level
+        # client is the only one holding the maximum level
+        level_counts = self._level_counts
+        max_level -= 1
+        while max_level > LOCK_NONE and not level_counts[max_level]:
+            max_level -= 1
+        return max_level
 
     def _get_caller_info(self):
         """
@@ -317,187 +483,278 @@ class SharedExclusiveLock(object):
         to find out who is locking the database for too long.
 
         The returned value is retained for the duration of waiting for or holding the lock.
+        This is called with the mutex held.
         """
 
-    def _report_timeout(self, blocked_info):
+    def _report_timeout(self, blocked_info, lock_holders):
+        """
+        Logs that the client of *blocked_info* timed out. Called without
+        holding the mutex, *lock_holders* is a snapshot of the lock holders as
+        list of (client, level, caller info) tuples, or None if debug logging
+        is disabled.
+        """
         _logger.warn("Timed out waiting for %s lock on %r (timeout=%s seconds).",
                 blocked_info.level_name, self.resource, self.timeout)
+        if lock_holders is None:
+            return
         _logger.debug("Lock holders:")
-        for client, level in self._lock_holders.iteritems():
+        for client, level, caller_info in lock_holders:
             levelname = LEVEL_NAMES[level]
-            caller_info = self._lock_holder_caller_info.get(client)
             if client and isinstance(client, weakref.ref):
                 client = client()
             _logger.debug("  Client %r level %s, caller info %r", client, levelname, caller_info)
 
-    def _acquire_shared(self, client, old_level, caller_info):
-        lock_levels = [v for (k, v) in self._lock_holders.items() if k != client]
-        max_level = max(lock_levels) if lock_levels else LOCK_NONE
-
-        if max_level < LOCK_PENDING and not self._blocked_clients:
-            # Fast path: No conflicting lock.
-            self._lock_holders[client] = LOCK_SHARED
-            self._lock_holder_caller_info[client] = caller_info
-        else:
-            self._wait(client, LOCK_SHARED, caller_info)
-
     def _acquire_reserved(self, client, old_level, caller_info):
-        lock_levels = [v for (k, v) in self._lock_holders.items() if k != client]
-        max_level = max(lock_levels) if lock_levels else LOCK_NONE
+        max_level = self._other_max_level(client)
 
-        if max_level < LOCK_RESERVED and not self._blocked_clients:
+        if max_level < LOCK_RESERVED and self._queue_head is None:
             # Fast path: No conflicting lock.
-            self._lock_holders[client] = LOCK_RESERVED
-            self._lock_holder_caller_info[client] = caller_info
+            self._set_level(client, LOCK_RESERVED, caller_info)
         else:
             if old_level != LOCK_NONE:
                 raise DeadlockError()
-            self._wait(client, LOCK_RESERVED, caller_info)
+            return self._enqueue(client, LOCK_RESERVED, caller_info)
 
     def _acquire_exclusive(self, client, old_level, caller_info):
-        lock_levels = [v for (k, v) in self._lock_holders.items() if k != client]
-        max_level = max(lock_levels) if lock_levels else LOCK_NONE
+        max_level = self._other_max_level(client)
 
         if max_level == LOCK_NONE:
             # Fast path: No conflicting lock.
-            self._lock_holders[client] = LOCK_EXCLUSIVE
-            self._lock_holder_caller_info[client] = caller_info
+            self._set_level(client, LOCK_EXCLUSIVE, caller_info)
         elif max_level == LOCK_SHARED:
             # Have to wait for shared locks to be released.
-            self._lock_holders[client] = LOCK_PENDING
-            self._lock_holder_caller_info[client] = caller_info
-            self._wait(client, LOCK_EXCLUSIVE, caller_info, enqueue_front=True)
+            self._set_level(client, LOCK_PENDING, caller_info)
+            return self._enqueue(client, LOCK_EXCLUSIVE, caller_info, enqueue_front=True)
         else:   # max_level >= LOCK_RESERVED
             # We can not have a reserved or higher lock level if any other client has
             # a reserved or higher lock level.
             assert old_level == LOCK_NONE or old_level == LOCK_SHARED
 
             if old_level == LOCK_NONE:
-                self._wait(client, LOCK_EXCLUSIVE, caller_info)
+                return self._enqueue(client, LOCK_EXCLUSIVE, caller_info)
             else:
                 raise DeadlockError()
 
-    def _wait(self, client, level, caller_info, enqueue_front=False):
-        blocked_info = BlockedClientInfo(client, level, caller_info, self._mutex, self.timeout)
-        if enqueue_front:
-            self._blocked_clients.appendleft(blocked_info)
+    def _enqueue(self, client, level, caller_info, enqueue_front=False):
+        """
+        Adds *client* to the queue of blocked clients. Returns the
+        BlockedClientInfo to pass to _wait after releasing the mutex.
+        """
+        if self._free_blocked_infos:
+            blocked_info = self._free_blocked_infos.pop()
+            blocked_info.reset(client, level, caller_info, self.timeout)
         else:
-            self._blocked_clients.append(blocked_info)
-
-        blocked_info.wait()
-        if blocked_info.got_timeout():
-            self._report_timeout(blocked_info)
-            for pos in range(len(self._blocked_clients)):
-                if self._blocked_clients[pos] is blocked_info:
-                    del self._blocked_clients[pos]
-                    break
-            raise _LockTimeoutError()
-        assert self._lock_holders[client] == level
+            blocked_info = BlockedClientInfo(client, level, caller_info, self.timeout)
+        if self._queue_head is None:
+            self._queue_head = self._queue_tail = blocked_info
+        elif enqueue_front:
+            blocked_info._next = self._queue_head
+            self._queue_head._prev = blocked_info
+            self._queue_head = blocked_info
+        else:
+            blocked_info._prev = self._queue_tail
+            self._queue_tail._next = blocked_info
+            self._queue_tail = blocked_info
+        return blocked_info
+
+    def _remove(self, blocked_info):
+        """Removes *blocked_info* from the queue of blocked clients."""
+        prev_info = blocked_info._prev
+        next_info = blocked_info._next
+        if prev_info is None:
+            self._queue_head = next_info
+        else:
+            prev_info._next = next_info
+        if next_info is None:
+            self._queue_tail = prev_info
+        else:
+            next_info._prev = prev_info
+        blocked_info._prev = blocked_info._next = None
+
+    def _wait(self, blocked_info):
+        """
+        Waits until the lock was granted to the client in *blocked_info* by
+        _wakeup_blocked. Must be called without holding the mutex.
+        """
+        if blocked_info.wait():
+            # The event is set, so the granting thread is done with
+            # blocked_info and it can be reused. Only successful waits are
+            # recycled: after a timeout, a late signal() could still arrive.
+            # Appending to a list is atomic, no need for the mutex.
+            blocked_info.client = blocked_info.caller_info = None
+            self._free_blocked_infos.append(blocked_info)
+            return
+
+        with self._mutex:
+            # The lock may have been granted after the wait timed out but
+            # before we got the mutex back.
+            if not blocked_info.got_timeout():
+                return
+            self._remove(blocked_info)
+            granted = self._wakeup_blocked()
+
+            if _logger.isEnabledFor(logging.DEBUG):
+                lock_holders = [(client, level, self._lock_holder_caller_info.get(client))
+                        for (client, level) in self._lock_holders.iteritems()]
+            else:
+                lock_holders = None
+
+        for other_info in granted:
+            other_info.signal()
+        self._report_timeout(blocked_info, lock_holders)
+        raise _LockTimeoutError()
 
     def _wakeup_blocked(self):
-        while self._blocked_clients:
-            blocked_info = self._blocked_clients.popleft()
+        """
+        Grants the lock to blocked clients as far as possible. Returns the
+        list of BlockedClientInfo instances that got the lock; the caller must
+        signal them after releasing the mutex.
+        """
+        head = self._queue_head
+        if head is not None and head.level != LOCK_EXCLUSIVE:
+            # Common case while a writer is active: nothing can be granted.
+            # A client waiting for a shared or reserved lock holds no lock
+            # yet, so the maximum level is the one held by the other clients.
+            if self._max_level >= (LOCK_PENDING if head.level == LOCK_SHARED else LOCK_RESERVED):
+                return []
+
+        granted = []
+        while self._queue_head is not None:
+            blocked_info = self._queue_head
             client = blocked_info.client
             level = blocked_info.level
-            caller_info = blocked_info.caller_info
-            lock_levels = [v for (k, v) in self._lock_holders.items() if k != client]
-            max_level = max(lock_levels) if lock_levels else LOCK_NONE
+            max_level = self._other_max_level(client)
 
             if level == LOCK_SHARED:
-                if max_level < LOCK_PENDING:
-                    self._lock_holders[client] = LOCK_SHARED
-                    self._lock_holder_caller_info[client] = caller_info
-                    blocked_info.signal()
-                else:
-                    self._blocked_clients.appendleft(blocked_info)
+                if max_level >= LOCK_PENDING:
                     break
+                # Shared locks do not conflict with each other, so grant all
+                # shared requests at the front of the queue in one go.
+                while blocked_info is not None and blocked_info.level == LOCK_SHARED:
+                    self._remove(blocked_info)
+                    self._set_level(blocked_info.client, LOCK_SHARED, blocked_info.caller_info)
+                    blocked_info.grant()
+                    granted.append(blocked_info)
+                    blocked_info = self._queue_head
 
             elif level == LOCK_RESERVED:
-                if max_level < LOCK_RESERVED:
-                    self._lock_holders[client] = LOCK_RESERVED
-                    self._lock_holder_caller_info[client] = caller_info
-                    blocked_info.signal()
-                else:
-                    self._blocked_clients.appendleft(blocked_info)
+                if max_level >= LOCK_RESERVED:
                     break
+                self._remove(blocked_info)
+                self._set_level(client, LOCK_RESERVED, blocked_info.caller_info)
+                blocked_info.grant()
+                granted.append(blocked_info)
 
             elif level == LOCK_EXCLUSIVE:
                 if max_level == LOCK_NONE:
-                    self._lock_holders[client] = LOCK_EXCLUSIVE
-                    self._lock_holder_caller_info[client] = caller_info
-                    blocked_info.signal()
+                    self._remove(blocked_info)
+                    self._set_level(client, LOCK_EXCLUSIVE, blocked_info.caller_info)
+                    blocked_info.grant()
+                    granted.append(blocked_info)
                 elif max_level == LOCK_SHARED:
-                    self._lock_holders[client] = LOCK_PENDING
-                    self._lock_holder_caller_info[client] = caller_info
-                    self._blocked_clients.appendleft(blocked_info)
+                    self._set_level(client, LOCK_PENDING, blocked_info.caller_info)
                     break
                 else:   # max_level >= LOCK_RESERVED
-                    self._blocked_clients.appendleft(blocked_info)
                     break
             else:
                 raise Exception("Unexpected lock level in blocked queue: {0}".format(level))
 
-        self.check_invariant()
+        return granted
 
     def is_idle(self):
-        with self._mutex:
-            return not self._lock_holders
+        # Testing a dict for emptiness is atomic, no need for the mutex.
+        return not self._lock_holders
 
     def get_stats(self):
+        level_counts, blocked_count = self._get_counts()
+        return dict((level, count) for (level, count) in enumerate(level_counts) if count), blocked_count
+
+    def _get_counts(self):
+        """
+        Returns a copy of _level_counts (the number of clients holding each
+        lock level, indexed by level) and the number of blocked clients.
+        """
         with self._mutex:
-            level_counts = {}
-            for level in self._lock_holders.values():
-                level_counts[level] = level_counts.get(level, 0) + 1
-            blocked_count = len(self._blocked_clients)
+            level_counts = self._level_counts[:]
+            blocked_count = 0
+            blocked_info = self._queue_head
+            while blocked_info is not None:
+                blocked_count += 1
+                blocked_info = blocked_info._next
 
         return level_counts, blocked_count
 
     def __repr__(self):
-        level_counts, blocked_count = self.get_stats()
+        if not self._lock_holders and self._queue_head is None:
+            # Idle: no need to take the mutex and collect statistics
+            return _format_state(type(self).__name__, (), 0)
 
-        if level_counts:
-            holder_parts = []
-            for level, count in sorted(level_counts.items()):
-                holder_parts.append("{0}: {1}".format(LEVEL_NAMES.get(level) or level, count))
-            holder_summary = ", ".join(holder_parts)
-        else:
-            holder_summary = "IDLE"
-
-        return '<{0} {1}, {2} blocked>'.format(type(self).__name__, holder_summary, blocked_count)
+        level_counts, blocked_count = self._get_counts()
+        return _format_state(type(self).__name__, enumerate(level_counts), blocked_count)
 
     def check_invariant(self):
-        with self._mutex:
-            lock_levels = set(self._lock_holders.values())
-            max_level = max(lock_levels) if lock_levels else LOCK_NONE
+        """
+        Asserts the consistency of the lock state. The caller must hold the mutex.
+
+        This is too expensive to run on every lock operation, the test suite
+        calls it via a subclass.
+        """
+        lock_levels = set(self._lock_holders.values())
+        max_level = max(lock_levels) if lock_levels else LOCK_NONE
+
+        # lock_levels can only include levels given as key in LEVEL_NAMES
+        assert lock_levels.issubset(LEVEL_NAMES)
+
+        # The queue of blocked clients is properly linked in both directions
+        blocked_clients = []
+        blocked_info = self._queue_head
+        prev_info = None
+        while blocked_info is not None:
+            assert blocked_info._prev is prev_info
+            blocked_clients.append(blocked_info)
+            prev_info = blocked_info
+            blocked_info = blocked_info._next
+        assert self._queue_tail is prev_info
 
-            # lock_levels can only include levels given as key in LEVEL_NAMES
-            assert lock_levels.issubset(LEVEL_NAMES)
+        # Nobody can be blocked if nobody is holding a lock.
+        assert not blocked_clients or self._lock_holders
 
-            # Nobody can be blocked if nobody is holding a lock.
-            assert not self._blocked_clients or self._lock_holders
+        # A shared lock request can only be blocked by >= PENDING
+        assert not (blocked_clients and blocked_clients[0].level == LOCK_SHARED) or max_level >= LOCK_PENDING
 
-            # A shared lock request can only be blocked by >= PENDING
-            assert not (self._blocked_clients and self._blocked_clients[0].level == LOCK_SHARED) or max_level >= LOCK_PENDING
+        # At most one client can have lock level > LOCK_SHARED
+        assert len([holder for (holder, level) in self._lock_holders.items() if level > LOCK_SHARED]) <= 1
 
-            # At most one client can have lock level > LOCK_SHARED
-            assert len([holder for (holder, level) in self._lock_holders.items() if level > LOCK_SHARED]) <= 1
+        # The cached level counts and maximum level match the lock holders
+        assert self._level_counts == [list(self._lock_holders.values()).count(level) for level in range(len(LEVEL_NAMES))]
+        assert self._max_level == max_level
 
-            # If a client holds an exclusive lock then he is the only lock holder
-            assert LOCK_EXCLUSIVE not in lock_levels or len(self._lock_holders) == 1
+        # If a client holds an exclusive lock then he is the only lock holder
+        assert LOCK_EXCLUSIVE not in lock_levels or len(self._lock_holders) == 1
 
-            # A client may only be pending if there are other shared locks to wait for
-            assert LOCK_PENDING not in lock_levels or [ \
-                    holder for (holder, level) in self._lock_holders.items() if level == LOCK_SHARED]
+        # A client may only be pending if there are other shared locks to wait for
+        assert LOCK_PENDING not in lock_levels or [ \
+                holder for (holder, level) in self._lock_holders.items() if level == LOCK_SHARED]
 
 
 class BlockedClientInfo(object):
 
-    def __init__(self, client, level, caller_info, mutex, timeout):
+    __slots__ = ("client", "level", "timeout", "caller_info", "_event", "_got_lock", "_prev", "_next")
+
+    def __init__(self, client, level, caller_info, timeout):
+        self._event = threading.Event()
+        #: Neighbours in the queue of blocked clients, see SharedExclusiveLock._queue_head
+        self._prev = None
+        self._next = None
+        self.reset(client, level, caller_info, timeout)
+
+    def reset(self, client, level, caller_info, timeout):
+        """Initializes the request, also used to reuse an instance whose client got the lock."""
         self.client = client
         self.level = level
         self.timeout = timeout
         self.caller_info = caller_info
-        self._condition = threading.Condition(mutex)
+        self._event.clear()
         self._got_lock = False
 
     @property
@@ -505,11 +762,16 @@ class BlockedClientInfo(object):
         return LEVEL_NAMES[self.level]
 
     def wait(self):
-        self._condition.wait(self.timeout)
+        """Waits for the blocked client to be signalled. Returns False on timeout."""
+        return self._event.wait(self.timeout)
 
-    def signal(self):
+    def grant(self):
+        """Marks the lock as granted. Called with the mutex of the lock held."""
         self._got_lock = True
-        self._condition.notify()
+
+    def signal(self):
+        """Wakes up the waiting client after grant(). Called without holding the mutex."""
+        self._event.set()
 
     def got_timeout(self):
         return not self._got_lock
@@ -21,19 +21,76 @@
 #    misrepresented as being the original software.
 # 3. This notice may not be removed or altered from any source distribution.
 
+import gc
 import unittest
 import threading
 import traceback
 import time
 import pysqlite2.dbapi2 as sqlite
-from pysqlite2.lock_manager import DefaultLockManager, DeadlockError, get_lock_manager, \
-        LOCK_NONE, LOCK_SHARED, LOCK_RESERVED, LOCK_PENDING, LOCK_EXCLUSIVE
+from pysqlite2.lock_manager import DefaultLockManager, DeadlockError, SharedExclusiveLock, get_lock_manager, \
+        SQLITE_IOERR_LOCK, LOCK_NONE, LOCK_SHARED, LOCK_RESERVED, LOCK_PENDING, LOCK_EXCLUSIVE
+
+
+class CheckedSharedExclusiveLock(SharedExclusiveLock):
+    """
+    SharedExclusiveLock that checks its invariant after each operation and
+    signals when a client gets blocked.
+    """
+
+    __slots__ = ("client_blocked",)
+
+    def __init__(self, *args, **kwargs):
+        SharedExclusiveLock.__init__(self, *args, **kwargs)
+        #: Set each time a client is added to the queue of blocked clients
+        self.client_blocked = threading.Event()
+
+    def _enqueue(self, client, level, caller_info, enqueue_front=False):
+        blocked_info = SharedExclusiveLock._enqueue(self, client, level, caller_info, enqueue_front)
+        self.client_blocked.set()
+        return blocked_info
+
+    def lock(self, level, client):
+        try:
+            return SharedExclusiveLock.lock(self, level, client)
+        finally:
+            with self._mutex:
+                self.check_invariant()
+
+    def unlock(self, level, client):
+        try:
+            return SharedExclusiveLock.unlock(self, level, client)
+        finally:
+            with self._mutex:
+                self.check_invariant()
+
+
+class Finalizer(object):
+    """Calls a function when it is finalized."""
+
+    def __init__(self, func):
+        self.func = func
+
+    def __del__(self):
+        self.func()
+
+
+def collect_cycle(func):
+    """
+    Runs the garbage collector on a reference cycle whose collection calls
+    *func*, like a connection in a reference cycle that unlocks its database
+    file when it is closed by the collector.
+    """
+    cycle = []
+    cycle.append(cycle)
+    cycle.append(Finalizer(func))
+    del cycle
+    gc.collect()
 
 
 class LockManagerTests(unittest.TestCase):
 
     def setUp(self):
-        self.manager = DefaultLockManager()
+        self.manager = DefaultLockManager(SharedExclusiveLock=CheckedSharedExclusiveLock)
         self.lockfunc = lambda x: None
 
     def tearDown(self):
@@ -67,7 +124,17 @@ class LockManagerTests(unittest.TestCase):
 
     def CheckUnlockWithoutLock(self):
         """Checks that unlock without first locking is harmless (SQLite seems to do it sometimes)."""
+        created = []
+
+        class CountingSharedExclusiveLock(CheckedSharedExclusiveLock):
+            def __init__(self, *args, **kwargs):
+                CheckedSharedExclusiveLock.__init__(self, *args, **kwargs)
+                created.append(self)
+
+        self.manager = DefaultLockManager(SharedExclusiveLock=CountingSharedExclusiveLock)
         self.manager.unlock("filename", LOCK_NONE, "client")
+        self.assertEqual(created, [])
+        self.assertTrue(self.manager.is_idle())
 
     def CheckRaiseLower(self):
         """Checks that the lock level can go up and down all the way."""
@@ -79,15 +146,51 @@ class LockManagerTests(unittest.TestCase):
         self.manager.unlock("filename", LOCK_NONE, "client")
         self.assertTrue(self.manager.is_idle())
 
+    def CheckCallerInfo(self):
+        """Checks that the caller info belongs to the lock level a client got with it."""
+        caller_info = ["reserved caller"]
+
+        class InfoSharedExclusiveLock(CheckedSharedExclusiveLock):
+            def _get_caller_info(self):
+                return caller_info[0]
+
+        self.manager = DefaultLockManager(SharedExclusiveLock=InfoSharedExclusiveLock)
+        self.manager.lock(self.lockfunc, "filename", LOCK_RESERVED, "client")
+        filelock = self.manager._filelocks["filename"]
+
+        # Lowering the lock level keeps the caller info
+        self.manager.unlock("filename", LOCK_SHARED, "client")
+        self.assertEqual(filelock._lock_holder_caller_info, {"client": "reserved caller"})
+
+        # Raising the lock level without caller info drops the stale one
+        caller_info[0] = None
+        self.manager.lock(self.lockfunc, "filename", LOCK_RESERVED, "client")
+        self.assertEqual(filelock._lock_holder_caller_info, {})
+
+        self.manager.unlock("filename", LOCK_NONE, "client")
+        self.assertTrue(self.manager.is_idle())
+
+    def CheckReprUnknownLevel(self):
+        """Checks that the repr of the lock manager shows lock levels it does not know by number."""
+        class CustomSharedExclusiveLock(CheckedSharedExclusiveLock):
+            def get_stats(self):
+                return {LOCK_SHARED: 1, 7: 2}, 0
+
+        self.manager = DefaultLockManager(SharedExclusiveLock=CustomSharedExclusiveLock)
+        self.manager.lock(self.lockfunc, "filename", LOCK_SHARED, "client")
+        self.assertEqual(repr(self.manager), "<DefaultLockManager SHARED: 1, 7: 2, 0 blocked>")
+        self.manager.unlock("filename", LOCK_NONE, "client")
+
     def CheckExclusiveBlocksShared(self):
         """Check that a shared lock must wait while an exclusive lock is set."""
         self.manager.lock(self.lockfunc, "filename", LOCK_EXCLUSIVE, "exclusive")
 
         def shared_locker():
             self.manager.lock(self.lockfunc, "filename", LOCK_SHARED, "shared")
+        filelock = self.manager._filelocks["filename"]
         t = threading.Thread(target=shared_locker)
         t.start()
-        t.join(0.1)
+        self.assertTrue(filelock.client_blocked.wait(5))
         self._print(self.manager)
         self.assertTrue(t.is_alive())
 
@@ -108,21 +211,24 @@ class LockManagerTests(unittest.TestCase):
             self.manager.lock(self.lockfunc, "filename", LOCK_SHARED, "shared_blocked")
 
 
+        filelock = self.manager._filelocks["filename"]
+
         self._print("An exclusive lock will block now (going to PENDING first)")
         t_exclusive = threading.Thread(target=exclusive_locker)
         t_exclusive.start()
-        t_exclusive.join(0.1)
+        self.assertTrue(filelock.client_blocked.wait(5))
+        filelock.client_blocked.clear()
         self._print(self.manager)
         self.assertTrue(t_exclusive.is_alive())
-        self.assertEqual(self.manager._filelocks["filename"]._lock_holders["exclusive"], LOCK_PENDING)
+        self.assertEqual(filelock._lock_holders["exclusive"], LOCK_PENDING)
 
         self._print("A shared lock will be added to the end of the queue")
         t_shared = threading.Thread(target=shared_locker)
         t_shared.start()
-        t_shared.join(0.1)
+        self.assertTrue(filelock.client_blocked.wait(5))
         self._print(self.manager)
         self.assertTrue(t_shared.is_alive())
-        self.assertTrue("shared_blocked" not in self.manager._filelocks["filename"]._lock_holders)
+        self.assertTrue("shared_blocked" not in filelock._lock_holders)
 
         self._print("Unblocking the exclusive locker")
         self.manager.unlock("filename", LOCK_NONE, "shared_1")
@@ -130,10 +236,10 @@ class LockManagerTests(unittest.TestCase):
         t_exclusive.join()
         self._print(self.manager)
 
-        # Shared lock must still be blocked
-        t_shared.join(0.1)
+        # Shared lock must still be blocked: it can only be granted when
+        # the exclusive lock is released.
         self.assertTrue(t_shared.is_alive())
-        self.assertTrue("shared_blocked" not in self.manager._filelocks["filename"]._lock_holders)
+        self.assertTrue("shared_blocked" not in filelock._lock_holders)
 
         self._print("Unblocking the shared locker")
         self.manager.unlock("filename", LOCK_NONE, "exclusive")
@@ -144,6 +250,107 @@ class LockManagerTests(unittest.TestCase):
         self.manager.unlock("filename", LOCK_NONE, "shared_blocked")
         self.assertTrue(self.manager.is_idle())
 
+    def CheckSharedGrantedTogether(self):
+        """
+        Checks that one unlock grants all shared requests queued at the front,
+        but not an exclusive request queued behind them.
+        """
+        self.manager.lock(self.lockfunc, "filename", LOCK_EXCLUSIVE, "writer")
+        filelock = self.manager._filelocks["filename"]
+
+        def start_locker(level, client):
+            t = threading.Thread(target=self.manager.lock, args=(self.lockfunc, "filename", level, client))
+            t.start()
+            self.assertTrue(filelock.client_blocked.wait(5))
+            filelock.client_blocked.clear()
+            return t
+
+        shared_clients = ["shared_{0}".format(i) for i in range(3)]
+        shared_threads = [start_locker(LOCK_SHARED, client) for client in shared_clients]
+        t_exclusive = start_locker(LOCK_EXCLUSIVE, "exclusive")
+
+        self.manager.unlock("filename", LOCK_NONE, "writer")
+        for t in shared_threads:
+            t.join(5)
+            self.assertFalse(t.is_alive())
+        for client in shared_clients:
+            self.assertEqual(filelock._lock_holders[client], LOCK_SHARED)
+
+        # The exclusive request has to wait for the shared locks.
+        self.assertTrue(t_exclusive.is_alive())
+        self.assertEqual(filelock._lock_holders["exclusive"], LOCK_PENDING)
+
+        for client in shared_clients:
+            self.manager.unlock("filename", LOCK_NONE, client)
+        t_exclusive.join()
+        self.assertEqual(filelock._lock_holders, {"exclusive": LOCK_EXCLUSIVE})
+        self.manager.unlock("filename", LOCK_NONE, "exclusive")
+        self.assertTrue(self.manager.is_idle())
+
+    def CheckTimeout(self):
+        """Checks that a blocked client gives up after the timeout without leaving state behind."""
+        self.manager = DefaultLockManager(timeout=0.1, SharedExclusiveLock=CheckedSharedExclusiveLock)
+        self.manager.lock(self.lockfunc, "filename", LOCK_EXCLUSIVE, "exclusive")
+        self.assertRaises(DeadlockError, self.manager.lock, self.lockfunc, "filename", LOCK_SHARED, "shared")
+        self.assertEqual(self.manager._filelocks["filename"].get_stats(), ({LOCK_EXCLUSIVE: 1}, 0))
+
+        self.manager.unlock("filename", LOCK_NONE, "exclusive")
+        self.assertTrue(self.manager.is_idle())
+
+    def CheckBlockedClientInfoReused(self):
+        """Checks that the BlockedClientInfo of a client that got the lock is reset and reused."""
+        enqueued = []
+
+        class RecordingSharedExclusiveLock(CheckedSharedExclusiveLock):
+            def _enqueue(self, client, level, caller_info, enqueue_front=False):
+                blocked_info = CheckedSharedExclusiveLock._enqueue(self, client, level, caller_info, enqueue_front)
+                enqueued.append((blocked_info, blocked_info.client, blocked_info._got_lock, blocked_info._event.is_set()))
+                return blocked_info
+
+        self.manager = DefaultLockManager(SharedExclusiveLock=RecordingSharedExclusiveLock)
+        self.manager.lock(self.lockfunc, "filename", LOCK_EXCLUSIVE, "exclusive")
+        filelock = self.manager._filelocks["filename"]
+
+        def shared_locker():
+            self.manager.lock(self.lockfunc, "filename", LOCK_SHARED, "shared")
+        t = threading.Thread(target=shared_locker)
+        t.start()
+        self.assertTrue(filelock.client_blocked.wait(5))
+        filelock.client_blocked.clear()
+        self.manager.unlock("filename", LOCK_NONE, "exclusive")
+        t.join()
+        first_info = enqueued[0][0]
+        self.assertEqual(filelock._free_blocked_infos, [first_info])
+        self.assertEqual(first_info.client, None)
+
+        # The shared lock keeps the file lock alive while another client blocks.
+        self.manager.lock(self.lockfunc, "filename", LOCK_RESERVED, "reserved")
+
+        def reserved_locker():
+            self.manager.lock(self.lockfunc, "filename", LOCK_RESERVED, "blocked")
+        t = threading.Thread(target=reserved_locker)
+        t.start()
+        self.assertTrue(filelock.client_blocked.wait(5))
+        self.assertEqual(enqueued[1], (first_info, "blocked", False, False))
+        self.assertEqual(filelock._free_blocked_infos, [])
+
+        self.manager.unlock("filename", LOCK_NONE, "reserved")
+        t.join()
+        self.assertEqual(filelock._free_blocked_infos, [first_info])
+        self.manager.unlock("filename", LOCK_NONE, "blocked")
+        self.manager.unlock("filename", LOCK_NONE, "shared")
+        self.assertTrue(self.manager.is_idle())
+
+    def CheckTimedOutBlockedClientInfoNotReused(self):
+        """Checks that the BlockedClientInfo of a client that timed out is not reused."""
+        self.manager = DefaultLockManager(timeout=0.1, SharedExclusiveLock=CheckedSharedExclusiveLock)
+        self.manager.lock(self.lockfunc, "filename", LOCK_EXCLUSIVE, "exclusive")
+        self.assertRaises(DeadlockError, self.manager.lock, self.lockfunc, "filename", LOCK_SHARED, "shared")
+        self.assertEqual(self.manager._filelocks["filename"]._free_blocked_infos, [])
+
+        self.manager.unlock("filename", LOCK_NONE, "exclusive")
+        self.assertTrue(self.manager.is_idle())
+
     def CheckMutualExclusion(self):
         """Checks that RESERVED or higher locks are mutually exclusive."""
 
@@ -156,10 +363,10 @@ class LockManagerTests(unittest.TestCase):
                 # In case the mutual exclusion does not work, this gives other threads
                 # the chance to take over.
                 time.sleep(0.1)
-                concurrent_threads.append(set(active_threads))
+                concurrent_threads.append(len(active_threads))
                 active_threads.discard(threading.current_thread())
                 self.manager.unlock("filename", LOCK_NONE, clientname)
-            except Exception, e:
+            except Exception as e:
                 traceback.print_exc()
                 exceptions.append(e)
 
@@ -175,8 +382,86 @@ class LockManagerTests(unittest.TestCase):
             for thread in threads:
                 thread.join()
             self.assertFalse(exceptions, "Exceptions in threads for lock sequence {0!r}: {1!r}.".format(lock_sequence, exceptions))
-            for entry in concurrent_threads:
-                self.assertTrue(len(entry) == 1, "Concurrent threads detected via lock sequence {0!r}: {1!r}".format(lock_sequence, entry))
+            for count in concurrent_threads:
+                self.assertEqual(count, 1, "{1} concurrent threads detected via lock sequence {0!r}".format(lock_sequence, count))
+
+    def _run_in_thread(self, func):
+        """Runs *func* in a separate thread and checks that it does not hang."""
+        t = threading.Thread(target=func)
+        t.daemon = True
+        t.start()
+        t.join(5)
+        self.assertFalse(t.is_alive(), "Thread hangs, probably in a deadlock.")
+
+    def CheckUnlockWhileCreatingFileLock(self):
+        """
+        Checks that unlock may be called from a finalizer run by the garbage
+        collector while the lock manager creates a file lock.
+        """
+        manager = self.manager
+
+        class CollectingSharedExclusiveLock(CheckedSharedExclusiveLock):
+            def __init__(self, *args, **kwargs):
+                CheckedSharedExclusiveLock.__init__(self, *args, **kwargs)
+                collect_cycle(lambda: manager.unlock("filename", LOCK_NONE, "finalized"))
+
+        self.manager = manager = DefaultLockManager(SharedExclusiveLock=CollectingSharedExclusiveLock)
+        self._run_in_thread(lambda: manager.lock(self.lockfunc, "filename", LOCK_SHARED, "client"))
+        manager.unlock("filename", LOCK_NONE, "client")
+        self.assertTrue(manager.is_idle())
+
+    def CheckUnlockWhileLocking(self):
+        """
+        Checks that unlock may be called from a finalizer run by the garbage
+        collector while a lock operation on the same file is in progress.
+        """
+        manager = self.manager
+        collecting = []
+
+        class CollectingSharedExclusiveLock(CheckedSharedExclusiveLock):
+            def _get_caller_info(self):
+                if collecting:
+                    collect_cycle(lambda: manager.unlock("filename", LOCK_NONE, "finalized"))
+
+        self.manager = manager = DefaultLockManager(SharedExclusiveLock=CollectingSharedExclusiveLock)
+        manager.lock(self.lockfunc, "filename", LOCK_SHARED, "finalized")
+        collecting.append(True)
+        self._run_in_thread(lambda: manager.lock(self.lockfunc, "filename", LOCK_SHARED, "client"))
+        manager.unlock("filename", LOCK_NONE, "client")
+        self.assertTrue(manager.is_idle())
+
+    def CheckReprWhileUnlockingInFinalizer(self):
+        """
+        Checks that the repr of the lock manager does not deadlock with a finalizer
+        that unlocks a file while another thread holds the mutex of a file lock.
+        """
+        manager = self.manager
+        collecting = []
+        in_hook = threading.Event()
+
+        class CollectingSharedExclusiveLock(CheckedSharedExclusiveLock):
+            def _get_caller_info(self):
+                if collecting:
+                    in_hook.set()
+                    # Give repr the time to wait for the mutex of this lock
+                    time.sleep(0.1)
+                    collect_cycle(lambda: manager.unlock("other", LOCK_NONE, "finalized"))
+
+        self.manager = manager = DefaultLockManager(SharedExclusiveLock=CollectingSharedExclusiveLock)
+        manager.lock(self.lockfunc, "other", LOCK_SHARED, "finalized")
+        manager.lock(self.lockfunc, "filename", LOCK_SHARED, "shared")
+        collecting.append(True)
+        t = threading.Thread(target=manager.lock, args=(self.lockfunc, "filename", LOCK_SHARED, "client"))
+        t.daemon = True
+        t.start()
+        self.assertTrue(in_hook.wait(5))
+        self._run_in_thread(lambda: repr(manager))
+        t.join(5)
+        self.assertFalse(t.is_alive(), "Thread hangs, probably in a deadlock.")
+
+        manager.unlock("filename", LOCK_NONE, "client")
+        manager.unlock("filename", LOCK_NONE, "shared")
+        self.assertTrue(manager.is_idle())
 
     def CheckLockFuncFailure(self):
         """
@@ -197,6 +482,49 @@ class LockManagerTests(unittest.TestCase):
         # that the client is holding a lock.
         self.assertTrue(self.manager.is_idle())
 
+    def CheckLockFuncFailureBackoff(self):
+        """Checks that the backoff delay grows with each failure and is reset by a successful lock."""
+        def bad_lockfunc(level):
+            raise SyntheticLockFuncError(5)
+
+        self.manager = DefaultLockManager(backoff=True, SharedExclusiveLock=CheckedSharedExclusiveLock)
+        key = ("filename", "client")
+        for expected_delay in (0.02, 0.04, 0.08):
+            self.assertRaises(SyntheticLockFuncError, self.manager.lock, bad_lockfunc, "filename", LOCK_SHARED, "client")
+            self.assertEqual(self.manager._backoff_delays[key], expected_delay)
+        self.assertTrue(self.manager.is_idle())
+
+        self.manager.lock(self.lockfunc, "filename", LOCK_SHARED, "client")
+        self.assertFalse(key in self.manager._backoff_delays)
+
+    def CheckLockFuncFailureBackoffClose(self):
+        """Checks that the backoff delay of a client is dropped when it unlocks completely after a failure."""
+        def bad_lockfunc(level):
+            raise SyntheticLockFuncError(5)
+
+        self.manager = DefaultLockManager(backoff=True, SharedExclusiveLock=CheckedSharedExclusiveLock)
+        self.assertRaises(SyntheticLockFuncError, self.manager.lock, bad_lockfunc, "filename", LOCK_SHARED, "client")
+        self.assertTrue(self.manager._backoff_delays)
+
+        # What closing the connection does
+        self.manager.unlock("filename", LOCK_NONE, "client")
+        self.assertEqual(self.manager._backoff_delays, {})
+        self.assertTrue(self.manager.is_idle())
+
+    def CheckLockFuncFailureNoBackoff(self):
+        """Checks that there is no backoff after a lock failure other than SQLITE_BUSY."""
+        def bad_lockfunc(level):
+            raise SyntheticLockFuncError(SQLITE_IOERR_LOCK)
+
+        self.manager = DefaultLockManager(backoff=True, SharedExclusiveLock=CheckedSharedExclusiveLock)
+        # Long enough to notice if the failure is delayed
+        self.manager.BACKOFF_MIN = 10
+        start = time.time()
+        self.assertRaises(SyntheticLockFuncError, self.manager.lock, bad_lockfunc, "filename", LOCK_SHARED, "client")
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(self.manager._backoff_delays, {})
+        self.assertTrue(self.manager.is_idle())
+
 
 class SyntheticLockFuncError(RuntimeError):
     """Exception raised in tests to simulate a failure."""
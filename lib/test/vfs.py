@@ -29,14 +29,23 @@ import pysqlite2.dbapi2 as sqlite
 
 class VFSTests(unittest.TestCase):
 
-    def setUp(self):
-        self.vfs = sqlite.VFS()
-        fd, self.temporary_file = tempfile.mkstemp()
+    @classmethod
+    def setUpClass(cls):
+        # The VFS object keeps no state between the tests, so share one.
+        cls.vfs = sqlite.VFS()
+        fd, cls.temporary_file = tempfile.mkstemp()
         os.close(fd)
 
-    def tearDown(self):
-        self.vfs = None
-        os.remove(self.temporary_file)
+    @classmethod
+    def tearDownClass(cls):
+        cls.vfs = None
+        os.remove(cls.temporary_file)
+
+    def setUp(self):
+        # Start each test with an empty file. All handles of the previous
+        # test are gone, and with them its locks.
+        fd = os.open(self.temporary_file, os.O_RDWR | os.O_TRUNC)
+        os.close(fd)
 
     def CheckVersionIsInt(self):
         self.assertIsInstance(self.vfs.version, int)
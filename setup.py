@@ -25,12 +25,16 @@
 # 3. This notice may not be removed or altered from any source distribution.
 
 import glob
-from itertools import ifilter
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import subprocess
 import sys
+import types
 
+from distutils.ccompiler import CCompiler
+from distutils.command.build_ext import build_ext
 from distutils.core import setup, Extension, Command
 
 import cross_bdist_wininst
@@ -145,10 +149,51 @@ def get_cipher_ext():
                      extra_link_args=extra_link_args, define_macros=DEFINE_MACROS + extra_macros)
 
 
+def parallel_compile(self, sources, output_dir=None, macros=None, include_dirs=None, debug=0,
+                     extra_preargs=None, extra_postargs=None, depends=None):
+    """
+    Replacement for CCompiler.compile which compiles the source files of an
+    extension in parallel, using one thread per CPU. The threads only wait
+    for the compiler processes. Compilers that override compile (like MSVC)
+    are not affected.
+    """
+    macros, objects, extra_postargs, pp_opts, build = self._setup_compile(
+            output_dir, macros, include_dirs, sources, depends, extra_postargs)
+    cc_args = self._get_cc_args(pp_opts, debug, extra_preargs)
+
+    def compile_object(obj):
+        try:
+            src, ext = build[obj]
+        except KeyError:
+            return
+        self._compile(obj, src, ext, cc_args, extra_postargs, pp_opts)
+
+    try:
+        jobs = multiprocessing.cpu_count()
+    except NotImplementedError:
+        jobs = 1
+    pool = ThreadPool(jobs)
+    try:
+        pool.map(compile_object, objects)
+    finally:
+        pool.close()
+        pool.join()
+    return objects
+
+
+class ParallelBuildExt(build_ext):
+    """build_ext which compiles the source files of each extension in parallel."""
+
+    def build_extensions(self):
+        # Only replace the generic implementation, see parallel_compile
+        if getattr(self.compiler.__class__.compile, "__func__", None) is CCompiler.compile.__func__:
+            self.compiler.compile = types.MethodType(parallel_compile, self.compiler)
+        build_ext.build_extensions(self)
+
+
 def determine_version(module_h_path):
-    version_re = re.compile('#define PYSQLITE_VERSION "(.*)"')
     with open(module_h_path) as f:
-        match = next(ifilter(bool, (version_re.match(line) for line in f)), None)
+        match = re.search(r'^#define PYSQLITE_VERSION "([^"]*)"', f.read(), re.M)
     if match is None:
         raise SystemExit("Fatal error: PYSQLITE_VERSION could not be detected!")
     return match.groups()[0]
@@ -185,7 +230,8 @@ def main():
             "Programming Language :: Python",
             "Topic :: Database :: Database Engines/Servers",
             "Topic :: Software Development :: Libraries :: Python Modules"],
-        cmdclass={"build_docs": DocBuilder, "cross_bdist_wininst": cross_bdist_wininst.bdist_wininst})
+        cmdclass={"build_docs": DocBuilder, "build_ext": ParallelBuildExt,
+                  "cross_bdist_wininst": cross_bdist_wininst.bdist_wininst})
     setup(**setup_args)
 
 if __name__ == "__main__":